@@ -1,20 +1,25 @@
 #! /usr/bin/env python
 
 import argparse
-from Bio import SeqIO
-from plastid.genomics.roitools import Transcript, SegmentChain
-import re
+from plastid.genomics.roitools import Transcript
+from pyfaidx import Fasta
+import itertools
 from collections import defaultdict
 import pandas as pd
 import numpy as np
 import multiprocessing as mp
-import subprocess as sp
 import os
+import string
 import sys
 from time import strftime
+try:
+    from numba import njit
+    _NUMBA_AVAILABLE = True
+except ImportError:  # numba is optional; without it, ORFs are found with a pure-python scan
+    _NUMBA_AVAILABLE = False
 
 parser = argparse.ArgumentParser(description='Identify all possible ORFs in a transcriptome. ORF-RATER will evaluate translation of only these ORFs.')
-parser.add_argument('genomefasta', help='Path to genome FASTA-file')
+parser.add_argument('genomefasta', help='Path to genome FASTA-file. A samtools-style index (GENOMEFASTA.fai) will be created if not already present')
 parser.add_argument('--tfamstem', default='tfams', help='Transcript family information generated by make_tfams.py. Both TFAMSTEM.txt and '
                                                         'TFAMSTEM.bed should exist. (Default: tfams)')
 parser.add_argument('--orfstore', default='orf.h5',
@@ -69,45 +74,82 @@ if opts.verbose:
     logprint('Reading transcriptome and genome')
 
 
-def seq_to_regex(inp, flags=0, nucleotide_table=IUPAC_TABLE_DNA):
-    """Convert a nucleotide sequence of IUPAC nucleotide characters as a regular expression.
-    Ambiguous IUPAC characters are converted to groups (e.g. `'Y'` to `'[CTU]'`),
-    and T and U are considered equivalent.
-
-    Modified from the function in plastid.genomics.seqtools
-
-    Parameters
-    ----------
-    inp : str
-        Nucleotide sequence using IUPAC nucleotide codes
-
-    flags : int, optional
-        Flags to pass to :py:func:`re.compile` (Default: 0 / no flags)
-
-    Examples
-    --------
-    Convert a sequence to a regex::
-
-        >>> seq_to_regex("CARYYA").pattern
-        'CA[AG][CTU][CTU]A'
-
-
-    Returns
-    -------
-    :py:class:`re.RegexObject`
-        Regular expression pattern corresponding to IUPAC sequence in `inp`
-    """
-    out = []
-    for ch in inp.upper():
-        if len(nucleotide_table.get(ch, ch)) == 1:
-            out.append(ch)
-        else:
-            out.append("["+"".join(nucleotide_table.get(ch, ch))+"]")
-
-    return re.compile("".join(out), flags=flags)
-
-START_RE = seq_to_regex('|'.join(opts.codons), nucleotide_table=IUPAC_TABLE_DNA)
-STOP_RE = re.compile(r'(?:...)*?(?:TAG|TAA|TGA)')
+def _expand_iupac(inp, nucleotide_table=IUPAC_TABLE_DNA):
+    """Expand a nucleotide sequence of IUPAC nucleotide characters into the set of unambiguous sequences it represents, e.g. 'NTG' to
+    {'ATG', 'CTG', 'GTG', 'TTG'}. T and U are considered equivalent, and output sequences contain only A, C, G, and T."""
+    return {''.join(seq) for seq in itertools.product(*[nucleotide_table[ch] for ch in inp.upper()])}
+
+# start codons are always exactly 3 nt, so can be matched by set lookups (or lookup tables) rather than regular expressions
+START_CODONS = frozenset().union(*[_expand_iupac(codon) for codon in opts.codons])
+STOP_CODONS = {'TAG', 'TAA', 'TGA'}
+START_CATEGORIES = sorted(START_CODONS)  # categories of the codon column, the same for every tfam
+
+# for the ORF scan, nucleotides are encoded as 0-3 (ambiguous as 4) and each codon as a 2-bit-packed index 0-63 (64 if ambiguous),
+# so that start and stop codons can both be identified in a single pass using lookup tables
+_NT_CODES = np.full(256, 4, dtype='i4')
+for (nt_code, nt) in enumerate('ACGT'):
+    _NT_CODES[ord(nt)] = nt_code
+
+
+def _codon_indices(myseq):
+    """Convert an uppercase nucleotide sequence to an array of the indices of the codons beginning at each position"""
+    nts = _NT_CODES[np.frombuffer(myseq, dtype='u1')]
+    codon_idx = (nts[:-2] << 4) | (nts[1:-1] << 2) | nts[2:]
+    codon_idx[((nts[:-2] | nts[1:-1] | nts[2:]) & 4) > 0] = 64
+    return codon_idx
+
+_START_LUT = np.zeros(65, dtype=np.bool)
+_START_LUT[[_codon_indices(codon)[0] for codon in START_CODONS]] = True
+_STOP_LUT = np.zeros(65, dtype=np.bool)
+_STOP_LUT[[_codon_indices(codon)[0] for codon in STOP_CODONS]] = True
+
+if _NUMBA_AVAILABLE:
+    @njit(cache=True)
+    def _scan_orfs(codon_idx, start_lut, stop_lut):
+        """Compiled equivalent of the scan in _find_all_orfs, operating on the output of _codon_indices. Returns (startpos, stoppos) arrays"""
+        n = codon_idx.shape[0]
+        startpos = np.empty(n, dtype=np.int32)
+        stoppos = np.empty(n, dtype=np.int32)
+        next_stop = np.zeros(3, dtype=np.int32)
+        nstarts = 0
+        for i in range(n-1, -1, -1):
+            if stop_lut[codon_idx[i]]:
+                next_stop[i % 3] = i+3
+            if start_lut[codon_idx[i]]:
+                startpos[nstarts] = i
+                stoppos[nstarts] = next_stop[i % 3]
+                nstarts += 1
+        return startpos[:nstarts][::-1], stoppos[:nstarts][::-1]
+
+    _scan_orfs(_codon_indices('ATGTAA'), _START_LUT, _STOP_LUT)  # compile now, so that worker processes inherit the compiled function
+
+
+def _parse_bed_blocks(line):
+    """Extract (chrom, strand, block_starts, block_ends) from a BED12 line, where block_starts and block_ends are arrays of genomic coordinates"""
+    ls = line.split()
+    block_starts = int(ls[1]) + np.array([int(x) for x in ls[11].rstrip(',').split(',')], dtype='i4')
+    block_ends = block_starts + np.array([int(x) for x in ls[10].rstrip(',').split(',')], dtype='i4')
+    return ls[0], ls[5], block_starts, block_ends
+
+
+def _get_position_list(blocks):
+    """Genomic positions covered by blocks (as returned by _parse_bed_blocks), in stranded order"""
+    (chrom, strand, block_starts, block_ends) = blocks
+    pos_list = np.concatenate([np.arange(start, end, dtype='i4') for (start, end) in zip(block_starts, block_ends)])
+    return pos_list[::-1] if strand == '-' else pos_list
+
+
+def _get_sequence(blocks):
+    """Uppercase sequence covered by blocks (as returned by _parse_bed_blocks), reverse-complemented if on the minus strand"""
+    (chrom, strand, block_starts, block_ends) = blocks
+    chromseq = genome[chrom]
+    seq = str(''.join([chromseq[start:end] for (start, end) in zip(block_starts.tolist(), block_ends.tolist())]))
+    # pyfaidx returns unicode under python 2, but the string.maketrans tables below only work with str
+    return seq[::-1].translate(_UPPER_COMPLEMENT) if strand == '-' else seq.translate(_UPPER)
+
+# translation tables to uppercase (and complement) a whole transcript in a single call
+_UPPER = string.maketrans(string.ascii_lowercase, string.ascii_uppercase)
+_UPPER_COMPLEMENT = string.maketrans('ACGTRYKMBVDHSWN' + 'ACGTRYKMBVDHSWN'.lower(), 'TGCAYRMKVBHDSWN' * 2)
 
 # hash transcripts by ID for easy reference later
 with open(opts.inbed, 'rU') as inbed:
@@ -118,11 +160,20 @@ with open('%s.txt' % opts.tfamstem, 'rU') as tfamtable:
     for line in tfamtable:
         ls = line.strip().split()
         tfamtids[ls[1]].append(ls[0])
+# parsed once here, rather than in each worker; only transcripts in a tfam are needed, which also skips any track or browser lines
+bed_blocks = {tid: _parse_bed_blocks(bedlinedict[tid]) for tids in tfamtids.itervalues() for tid in tids}
 
 with open('%s.bed' % opts.tfamstem, 'rU') as tfambed:
     tfambedlines = {line.split()[3]: line for line in tfambed}
 
-genome = SeqIO.to_dict(SeqIO.parse(opts.genomefasta, 'fasta'))
+Fasta(opts.genomefasta).close()  # check the genome FASTA, and index it if no index exists yet, before any workers are started
+genome = None  # opened separately in each worker process by _open_genome
+
+
+def _open_genome():
+    """Open the genome FASTA for on-demand reads. Each worker process opens its own copy, so that workers do not share a file offset."""
+    global genome
+    genome = Fasta(opts.genomefasta, as_raw=True)
 
 if not opts.ignoreannotations:
     annot_tfam_lookups = [tfamtids]
@@ -151,18 +202,21 @@ tfams_with_annots = set(sum([x.keys() for x in annot_tfam_lookups], []))
 
 def _find_all_orfs(myseq):
     """Identify ORFs, or at least starts.
-    Returns list of (start, stop, codon), where stop == 0 if no valid stop codon is present and codon is e.g. 'ATG'.
-    Starts and stops are defined by START_RE and STOP_RE, respectively
+    Returns (startpos, stoppos, codons), where startpos and stoppos are arrays of transcript coordinates, stoppos == 0 if no valid stop codon
+    is present, and each element of codons is e.g. 'ATG'. Starts and stops are defined by START_CODONS and STOP_CODONS, respectively
     """
-    result = []
-    for i in range(len(myseq)-2):
-        if START_RE.match(myseq[i:i+3]):
-            m = STOP_RE.match(myseq[i:])
-            if m:
-                result.append((i, m.end()+i, myseq[i:i+3]))
-            else:
-                result.append((i, 0, myseq[i:i+3]))
-    return result
+    codon_idx = _codon_indices(myseq)
+    if _NUMBA_AVAILABLE:
+        (startpos, stoppos) = _scan_orfs(codon_idx, _START_LUT, _STOP_LUT)
+    else:
+        no_stop = np.iinfo('i4').max
+        next_stop = np.where(_STOP_LUT[codon_idx], np.arange(3, len(codon_idx)+3, dtype='i4'), no_stop)  # 3' end of stop codon at each position
+        for frame in range(3):  # propagate each stop upstream to every position in its frame, until the next stop is reached
+            next_stop[frame::3] = np.minimum.accumulate(next_stop[frame::3][::-1])[::-1]
+        next_stop[next_stop == no_stop] = 0
+        startpos = np.flatnonzero(_START_LUT[codon_idx]).astype('i4')
+        stoppos = next_stop[startpos]
+    return startpos, stoppos, [myseq[i:i+3] for i in startpos]
 
 
 def _name_orf(tfam, gcoord, AAlen):
@@ -173,73 +227,70 @@ def _name_orf(tfam, gcoord, AAlen):
 def _identify_tfam_orfs(tup):
     """Identify all of the possible ORFs within a family of transcripts. Relevant information such as genomic start and stop positions, amino acid
     length, and initiation codon will be collected for each ORF. Additionally, each ORF will be assigned a unique 'orfname', such that if it occurs
-    on multiple transcripts, it can be recognized as the same ORF."""
+    on multiple transcripts, it can be recognized as the same ORF. Results are returned as (tfam, tfam_orfs), or None if no ORFs are found."""
     (tfam, tids) = tup
-    currtfam = SegmentChain.from_bed(tfambedlines[tfam])
-    chrom = currtfam.chrom
-    strand = currtfam.strand
-    tfam_genpos = np.array(currtfam.get_position_list())
-    if strand == '-':
-        tfam_genpos = tfam_genpos[::-1]
-    tmask = np.empty((len(tids), len(tfam_genpos)), dtype=np.bool)  # True if transcript covers that position, False if not
-    tfam_orfs = []
-    tidx_lookup = {}
-    for tidx, tid in enumerate(tids):
-        tidx_lookup[tid] = tidx
-        curr_trans = Transcript.from_bed(bedlinedict[tid])
-        tmask[tidx, :] = np.in1d(tfam_genpos, curr_trans.get_position_list(), assume_unique=True)
-        trans_orfs = _find_all_orfs(curr_trans.get_sequence(genome).upper())
-        if trans_orfs:
-            (startpos, stoppos, codons) = zip(*trans_orfs)
-            startpos = np.array(startpos, dtype='i4')
-            stoppos = np.array(stoppos, dtype='i4')
-
-            gcoords = np.array([curr_trans.get_genomic_coordinate(x)[1] for x in startpos], dtype='i4')
-
-            stop_present = (stoppos > 0)
-            gstops = np.zeros(len(trans_orfs), dtype='i4')
-            gstops[stop_present] = \
-                np.array([curr_trans.get_genomic_coordinate(x - 1)[1] for x in stoppos[stop_present]]) + (1 if strand == '+' else -1)
+    tfam_blocks = _parse_bed_blocks(tfambedlines[tfam])
+    (chrom, strand) = tfam_blocks[:2]
+    tfam_genpos = _get_position_list(tfam_blocks)
+    gpos_to_col = dict(zip(tfam_genpos.tolist(), xrange(len(tfam_genpos))))  # maps each genomic position to its index in tfam_genpos
+    (all_tids, all_tcoords, all_tstops, all_gcoords, all_gstops, all_codons, all_AAlens) = ([], [], [], [], [], [], [])
+    # per-ORF values accumulated across all transcripts in the tfam, to be assembled into a single DataFrame
+    trans_cols = {}  # for each transcript, the index in tfam_genpos of each of its positions, in stranded order
+    for tid in tids:
+        curr_pos_list = _get_position_list(bed_blocks[tid])
+        trans_cols[tid] = np.fromiter((gpos_to_col[pos] for pos in curr_pos_list.tolist()), dtype='i4', count=len(curr_pos_list))
+        (startpos, stoppos, codons) = _find_all_orfs(_get_sequence(bed_blocks[tid]))
+        if len(startpos) > 0:
+            gcoords = curr_pos_list[startpos]  # curr_pos_list maps transcript coordinates to genomic coordinates
+
+            stop_present = (stoppos > 0)  # where stoppos == 0, the values computed below are discarded, so stoppos - 1 == -1 is harmless
+            gstops = np.where(stop_present, curr_pos_list[stoppos - 1] + (1 if strand == '+' else -1), 0)
             # the decrementing/incrementing stuff preserves half-openness regardless of strand
-
-            AAlens = np.zeros(len(trans_orfs), dtype='i4')
-            AAlens[stop_present] = (stoppos[stop_present] - startpos[stop_present])/3 - 1
-            tfam_orfs.append(pd.DataFrame.from_items([('tfam', tfam),
-                                                      ('tid', tid),
-                                                      ('tcoord', startpos),
-                                                      ('tstop', stoppos),
-                                                      ('chrom', chrom),
-                                                      ('gcoord', gcoords),
-                                                      ('gstop', gstops),
-                                                      ('strand', strand),
-                                                      ('codon', codons),
-                                                      ('AAlen', AAlens),
-                                                      ('orfname', '')]))
-    if any(x is not None for x in tfam_orfs):
+            AAlens = np.where(stop_present, (stoppos - startpos)//3 - 1, 0)
+            all_tids.extend([tid] * len(startpos))
+            all_tcoords.append(startpos)
+            all_tstops.append(stoppos)
+            all_gcoords.append(gcoords)
+            all_gstops.append(gstops)
+            all_codons.extend(codons)
+            all_AAlens.append(AAlens)
+    if all_tids:
         orf_pos_dict = {}
-        tfam_orfs = pd.concat(tfam_orfs, ignore_index=True)
+        tfam_orfs = pd.DataFrame({'tfam': pd.Categorical.from_codes(np.zeros(len(all_tids), dtype='i1'), [tfam]),
+                                  'tid': pd.Categorical(all_tids, categories=tids),
+                                  'tcoord': np.concatenate(all_tcoords),
+                                  'tstop': np.concatenate(all_tstops),
+                                  'chrom': chrom,
+                                  'gcoord': np.concatenate(all_gcoords),
+                                  'gstop': np.concatenate(all_gstops),
+                                  'strand': strand,
+                                  'codon': pd.Categorical(all_codons, categories=START_CATEGORIES),
+                                  'AAlen': np.concatenate(all_AAlens),
+                                  'orfname': ''},
+                                 columns=['tfam', 'tid', 'tcoord', 'tstop', 'chrom', 'gcoord', 'gstop', 'strand', 'codon', 'AAlen', 'orfname'])
         for ((gcoord, AAlen), gcoord_grp) in tfam_orfs.groupby(['gcoord', 'AAlen']):  # group by genomic start position and length
             if len(gcoord_grp) == 1:
                 tfam_orfs.loc[gcoord_grp.index, 'orfname'] = _name_orf(tfam, gcoord, AAlen)
             else:
-                orf_gcoords = np.vstack(np.flatnonzero(tmask[tidx_lookup[tid], :])[tcoord:tstop]
-                                        for (tid, tcoord, tstop) in gcoord_grp[['tid', 'tcoord', 'tstop']].itertuples(False))
-                if (orf_gcoords == orf_gcoords[0, :]).all():  # all of the grouped ORFs are identical, so should receive the same name
+                orf_cols = np.vstack([trans_cols[tid][tcoord:tstop]
+                                      for (tid, tcoord, tstop) in gcoord_grp[['tid', 'tcoord', 'tstop']].itertuples(False)])
+                # ORFs sharing a start and length have the same number of positions, so rows can be compared directly
+                if orf_cols.shape[1] == 0:  # nonstop ORFs have no positions to compare (and np.unique fails on zero-width rows)
+                    first_rows = [0]
+                else:
+                    (_, first_rows, row_idx) = np.unique(orf_cols, axis=0, return_index=True, return_inverse=True)
+                if len(first_rows) == 1:  # all of the grouped ORFs are identical, so should receive the same name
                     orfname = _name_orf(tfam, gcoord, AAlen)
                     tfam_orfs.loc[gcoord_grp.index, 'orfname'] = orfname
-                    orf_pos_dict[orfname] = tfam_genpos[orf_gcoords[0, :]]
+                    orf_pos_dict[orfname] = tfam_genpos[orf_cols[0]]
                 else:
-                    named_so_far = 0
-                    unnamed = np.ones(len(gcoord_grp), dtype=np.bool)
                     basename = _name_orf(tfam, gcoord, AAlen)
-                    while unnamed.any():
-                        next_gcoords = orf_gcoords[unnamed, :][0, :]
-                        identicals = (orf_gcoords == next_gcoords).all(1)
-                        orfname = '%s_%d' % (basename, named_so_far)
-                        tfam_orfs.loc[gcoord_grp.index[identicals], 'orfname'] = orfname
-                        orf_pos_dict[orfname] = tfam_genpos[next_gcoords]
-                        unnamed[identicals] = False
-                        named_so_far += 1
+                    row_order = np.argsort(first_rows)  # number distinct ORFs in order of first appearance
+                    row_names = np.empty(len(first_rows), dtype=object)
+                    row_names[row_order] = ['%s_%d' % (basename, named_so_far) for named_so_far in xrange(len(first_rows))]
+                    tfam_orfs.loc[gcoord_grp.index, 'orfname'] = row_names[row_idx]
+                    for (orfname, first_row) in zip(row_names, first_rows):
+                        orf_pos_dict[orfname] = tfam_genpos[orf_cols[first_row]]
 
         # Now that the ORFs have been found and named, figure out their orftype
         tfam_orfs['annot_start'] = False
@@ -282,7 +333,7 @@ def _identify_tfam_orfs(tup):
                     else:
                         if tid is None or tcoord is None or tstop is None:
                             (tid, tcoord, tstop) = tfam_orfs.loc[tfam_orfs['orfname'] == orfname, ['tid', 'tcoord', 'tstop']].iloc[0]
-                        res = tfam_genpos[np.flatnonzero(tmask[tidx_lookup[tid], :])[tcoord:tstop]]
+                        res = tfam_genpos[trans_cols[tid][tcoord:tstop]]
                         orf_pos_dict[orfname] = res
                         return res
 
@@ -457,27 +508,57 @@ def _identify_tfam_orfs(tup):
                         # overlaps out-of-frame with a CDS, and not on the same transcript with a CDS: Giso => "genomic isoform"
 
                 assert not tfam_orfs['untyped'].any()
-        return tfam_orfs.drop('untyped', axis=1)
+        return tfam, tfam_orfs.drop('untyped', axis=1)
     else:
         return None
 
 if opts.verbose:
     logprint('Identifying ORFs within each transcript family')
 
-workers = mp.Pool(opts.numproc)
-all_orfs = pd.concat(workers.map(_identify_tfam_orfs, tfamtids.iteritems()), ignore_index=True)
+
+def _tfam_size(tids):
+    """Total length of the transcripts in a tfam, used to estimate how long each tfam will take"""
+    return sum((bed_blocks[tid][3] - bed_blocks[tid][2]).sum() for tid in tids)
+
+# handle the largest tfams first, so that they do not hold up completion
+tfamlist = sorted(tfamtids.iteritems(), key=lambda item: _tfam_size(item[1]), reverse=True)
+workers = mp.Pool(opts.numproc, initializer=_open_genome)
+tfam_results = [res for res in workers.imap_unordered(_identify_tfam_orfs, tfamlist, chunksize=4) if res is not None]
 workers.close()
+tfam_results.sort(key=lambda res: res[0])  # results arrive in whatever order they finish; sort by tfam so that the output is reproducible
+if not tfam_results:
+    raise ValueError('No ORFs found in any transcript family; check that %s.txt and %s.bed match %s' % (opts.tfamstem, opts.tfamstem, opts.inbed))
+
+# allocate the final table once and copy each tfam's rows into it, rather than concatenating many small DataFrames
+# tfam and tid have different categories in each tfam, so are stored as strings; codon is stored as codes, and converted to a categorical below
+first_orfs = tfam_results[0][1]
+all_orfs = pd.DataFrame({col: np.empty(sum(len(tfam_orfs) for (tfam, tfam_orfs) in tfam_results),
+                                       dtype=(first_orfs[col].cat.codes.dtype if col == 'codon' else
+                                              object if first_orfs[col].dtype.name == 'category' else first_orfs[col].dtype))
+                         for col in first_orfs.columns}, columns=first_orfs.columns)
+all_orfs_cols = {col: all_orfs[col].values for col in all_orfs.columns}  # views into all_orfs, so that it can be filled in place
+offset = 0
+for (tfam, tfam_orfs) in tfam_results:
+    nrows = len(tfam_orfs)
+    for col in tfam_orfs.columns:
+        if col == 'codon':
+            all_orfs_cols[col][offset:offset+nrows] = tfam_orfs[col].cat.codes.values
+        elif tfam_orfs[col].dtype.name == 'category':
+            all_orfs_cols[col][offset:offset+nrows] = np.asarray(tfam_orfs[col].cat.categories, dtype=object)[tfam_orfs[col].cat.codes.values]
+        else:
+            all_orfs_cols[col][offset:offset+nrows] = tfam_orfs[col].values
+    offset += nrows
+del tfam_results, all_orfs_cols
+all_orfs['codon'] = pd.Categorical.from_codes(all_orfs['codon'].values, START_CATEGORIES)
 
-for catfield in ['chrom', 'strand', 'codon', 'orftype']:
+for catfield in ['chrom', 'strand', 'orftype']:
     all_orfs[catfield] = all_orfs[catfield].astype('category')  # saves disk space and read/write time
 
 if opts.verbose:
     logprint('Saving results')
 
-origname = opts.orfstore+'.tmp'
-all_orfs.to_hdf(origname, 'all_orfs', format='t', data_columns=True)
-sp.call(['ptrepack', origname, opts.orfstore])  # repack for efficiency
-os.remove(origname)
+all_orfs.to_hdf(opts.orfstore, 'all_orfs', mode='w', format='t', data_columns=True, complevel=1, complib='blosc')
+# compressing on write, rather than repacking with ptrepack, avoids writing the table twice
 
 if opts.verbose:
     logprint('Tasks complete')